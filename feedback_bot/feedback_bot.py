@@ -2,13 +2,17 @@ import asyncio
 import logging
 import random
 import datetime
+import functools
+import itertools
 from asyncio import Task
-from typing import List, Dict, Union, Optional
+from typing import List, Dict, Union, Optional, Tuple, Callable, Awaitable
 
-from prometheus_client import Gauge, Counter, start_http_server
+from prometheus_async import aio
+from prometheus_async.aio.web import MetricsHTTPServer, start_http_server
+from prometheus_client import Gauge, Counter, Histogram
 from telethon import events, TelegramClient, Button
 
-from feedback_bot.schedule_store import ScheduleStore, ScheduledMessage, ScheduledForward
+from feedback_bot.schedule_store import ScheduleStore, ScheduledMessage, ScheduledForward, FEEDBACK_MESSAGE
 
 start_time = Gauge("feedbackbot_start_unixtime", "Unix timestamp of the last time the bot was started")
 latest_msg = Gauge(
@@ -31,10 +35,81 @@ press_count = Counter(
     "Total number of feedback buttons pressed by the bot",
     labelnames=["channel_id", "option"]
 )
+handler_latency = Histogram(
+    "feedbackbot_handler_latency_seconds",
+    "Time taken by the bot to handle each telegram event",
+    labelnames=["handler"]
+)
 logger = logging.getLogger(__name__)
 
 
+def _bind_msg_metrics(channel_id: int, reformat_type: str) -> Tuple[Gauge, Counter]:
+    return (
+        latest_msg.labels(channel_id=channel_id, reformat_type=reformat_type),
+        msg_count.labels(channel_id=channel_id, reformat_type=reformat_type),
+    )
+
+
+def _bind_press_metrics(channel_id: int, option: str) -> Tuple[Gauge, Counter]:
+    return (
+        latest_press.labels(channel_id=channel_id, option=option),
+        press_count.labels(channel_id=channel_id, option=option),
+    )
+
+
+class ConfigError(Exception):
+    def __init__(self, problems: List[str]) -> None:
+        super().__init__("Invalid config: " + "; ".join(problems))
+        self.problems = problems
+
+
+def _validate_options(options) -> bool:
+    if not isinstance(options, list) or not options:
+        return False
+    if isinstance(options[0], list):
+        return all(isinstance(row, list) and row and all(isinstance(o, str) for o in row) for row in options)
+    return all(isinstance(option, str) for option in options)
+
+
+def _is_int(value) -> bool:
+    # bool is a subclass of int, but true or false is never a valid id or port
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _validate_config(config: Dict) -> List[str]:
+    problems = []
+    for key in ["api_id", "api_hash", "bot_token"]:
+        if key not in config:
+            problems.append(f"{key} is missing")
+    if "prom_port" in config and not _is_int(config["prom_port"]):
+        problems.append("prom_port must be an int")
+    channels = config.get("channels")
+    if not isinstance(channels, list):
+        return problems + ["channels must be a list"]
+    for i, channel in enumerate(channels):
+        if not isinstance(channel, dict):
+            problems.append(f"channels[{i}] must be an object")
+            continue
+        for key in ["channel_id", "feedback_group_id"]:
+            if not _is_int(channel.get(key)):
+                problems.append(f"channels[{i}].{key} must be an int")
+        if "delay_feedback" in channel and not isinstance(channel["delay_feedback"], bool):
+            problems.append(f"channels[{i}].delay_feedback must be a bool")
+        if not _validate_options(channel.get("options")):
+            problems.append(f"channels[{i}].options must be a non-empty list of strings, or of lists of strings")
+    return problems
+
+
+@functools.lru_cache(maxsize=1024)
+def _user_name(first_name: Optional[str], last_name: Optional[str]) -> str:
+    return " ".join(filter(None, [first_name, last_name]))
+
+
 class Channel:
+    __slots__ = (
+        "channel_id", "options", "feedback_group_id", "delay_feedback", "_is_grid", "_flat_options", "_buttons",
+    )
+
     def __init__(
             self,
             channel_id: int,
@@ -46,23 +121,41 @@ class Channel:
         self.options = options
         self.feedback_group_id = feedback_group_id
         self.delay_feedback = delay_feedback
+        self._is_grid = bool(self.options) and isinstance(self.options[0], list)
+        if self._is_grid:
+            self._flat_options = list(itertools.chain.from_iterable(self.options))
+        else:
+            self._flat_options = list(self.options)
+        self._buttons = self._build_buttons()
 
-    @property
-    def buttons(self) -> Union[List[Button], List[List[Button]]]:
-        if isinstance(self.options[0], list):
+    def _build_buttons(self) -> Union[List[Button], List[List[Button]]]:
+        # Callback data holds the option's index in list_options(), as telegram limits it to 64 bytes.
+        # Older buttons hold "option:" and the option text, so indexes use a different prefix
+        indexes = itertools.count()
+        if self._is_grid:
             return [
-                [Button.inline(option, f"option:{option}") for option in row]
+                [Button.inline(option, b"opt:" + str(next(indexes)).encode("ascii")) for option in row]
                 for row in self.options
             ]
         return [
-            Button.inline(option, f"option:{option}")
+            Button.inline(option, b"opt:" + str(next(indexes)).encode("ascii"))
             for option in self.options
         ]
 
+    @property
+    def buttons(self) -> Union[List[Button], List[List[Button]]]:
+        return self._buttons
+
     def list_options(self) -> List[str]:
-        if isinstance(self.options[0], list):
-            return sum(self.options, [])
-        return self.options
+        return self._flat_options
+
+    def option_from_index(self, payload: bytes) -> Optional[str]:
+        if not payload.isdigit():
+            return None
+        index = int(payload)
+        if index >= len(self._flat_options):
+            return None
+        return self._flat_options[index]
 
     @classmethod
     def from_json(cls, config: Dict):
@@ -84,20 +177,47 @@ class FeedbackBot:
         self.prom_port = prom_port or 7066
         self.schedule_store = ScheduleStore.load_from_json(client)
         self.schedule_task: Optional[Task] = None
-        for chan in channels:
-            for reformat_type in ["edit", "resend"]:
-                latest_msg.labels(channel_id=chan.channel_id, reformat_type=reformat_type)
-                msg_count.labels(channel_id=chan.channel_id, reformat_type=reformat_type)
-            for option in chan.list_options():
-                latest_press.labels(channel_id=chan.channel_id, option=option)
-                press_count.labels(channel_id=chan.channel_id, option=option)
+        self.metrics_server: Optional[MetricsHTTPServer] = None
+        # Handlers for button callback data, keyed by the prefix before the first colon
+        self._callback_handlers: Dict[bytes, Callable[[events.CallbackQuery.Event, bytes], Awaitable[None]]] = {
+            b"opt": self.handle_option_button,
+            b"option": self.handle_legacy_option_button,
+        }
+        # Bind labelled metrics up front, so the handlers don't need to look up labels for each event
+        self._msg_metrics: Dict[Tuple[int, str], Tuple[Gauge, Counter]] = {
+            (chan.channel_id, reformat_type): _bind_msg_metrics(chan.channel_id, reformat_type)
+            for chan in channels
+            for reformat_type in ["edit", "resend"]
+        }
+        self._press_metrics: Dict[Tuple[int, str], Tuple[Gauge, Counter]] = {
+            (chan.channel_id, option): _bind_press_metrics(chan.channel_id, option)
+            for chan in channels
+            for option in chan.list_options()
+        }
+
+    def _record_press(self, channel_id: int, option: str) -> None:
+        metrics = self._press_metrics.get((channel_id, option))
+        if metrics is None:
+            # Buttons on older posts may have options which are no longer configured
+            metrics = self._press_metrics[(channel_id, option)] = _bind_press_metrics(channel_id, option)
+        latest, count = metrics
+        latest.set_to_current_time()
+        count.inc()
 
+    async def handle_message(self, event: events.NewMessage.Event) -> None:
+        if event.message.forward:
+            await self.handle_forwarded_message(event)
+        else:
+            await self.handle_new_message(event)
+
+    @aio.time(handler_latency.labels(handler="new_message"))
     async def handle_new_message(self, event: events.NewMessage.Event) -> None:
         channel = self.channel_dict.get(event.chat_id)
         if not channel:
             return
-        latest_msg.labels(channel_id=event.chat_id, reformat_type="edit").set_to_current_time()
-        msg_count.labels(channel_id=event.chat_id, reformat_type="edit").inc()
+        latest, count = self._msg_metrics[(event.chat_id, "edit")]
+        latest.set_to_current_time()
+        count.inc()
         logger.info("Editing message")
         await self.client.edit_message(
             event.chat,
@@ -105,12 +225,14 @@ class FeedbackBot:
             buttons=channel.buttons
         )
 
+    @aio.time(handler_latency.labels(handler="forwarded_message"))
     async def handle_forwarded_message(self, event: events.NewMessage.Event) -> None:
         channel = self.channel_dict.get(event.chat_id)
         if not channel:
             return
-        latest_msg.labels(channel_id=event.chat_id, reformat_type="resend").set_to_current_time()
-        msg_count.labels(channel_id=event.chat_id, reformat_type="resend").inc()
+        latest, count = self._msg_metrics[(event.chat_id, "resend")]
+        latest.set_to_current_time()
+        count.inc()
         logger.info("Resending message")
         await self.client.send_message(
             event.chat,
@@ -119,23 +241,40 @@ class FeedbackBot:
         )
         await self.client.delete_messages(event.chat, [event.message.id])
 
+    @aio.time(handler_latency.labels(handler="callback_button"))
     async def handle_callback_button(self, event: events.CallbackQuery.Event) -> None:
-        if not event.data.startswith(b"option:"):
+        prefix, _, payload = event.data.partition(b":")
+        handler = self._callback_handlers.get(prefix)
+        if handler is None:
+            return
+        await handler(event, payload)
+
+    async def handle_option_button(self, event: events.CallbackQuery.Event, payload: bytes) -> None:
+        channel = self.channel_dict.get(event.chat_id)
+        if not channel:
             return
+        option = channel.option_from_index(payload)
+        if option is None:
+            return
+        await self._handle_option_press(event, channel, option)
+
+    async def handle_legacy_option_button(self, event: events.CallbackQuery.Event, payload: bytes) -> None:
+        # Buttons posted before options were sent by index hold the option text itself
         channel = self.channel_dict.get(event.chat_id)
         if not channel:
             return
+        await self._handle_option_press(event, channel, payload.decode())
+
+    async def _handle_option_press(self, event: events.CallbackQuery.Event, channel: Channel, option: str) -> None:
         user = event.sender
-        user_name = " ".join(filter(None, [user.first_name, user.last_name]))
-        option = event.data.decode().split(":", 1)[1]
-        latest_press.labels(channel_id=event.chat_id, option=option).set_to_current_time()
-        press_count.labels(channel_id=event.chat_id, option=option).inc()
-        logger.info(f"Button press received: {option}")
+        user_name = _user_name(user.first_name, user.last_name)
+        self._record_press(event.chat_id, option)
+        logger.info("Button press received: %s", option)
         # If no delay, post the feedback now
         if not channel.delay_feedback:
             await self.client.send_message(
                 channel.feedback_group_id,
-                f"User [{user_name}](tg://user?id={user.id}) has sent feedback: {option}",
+                FEEDBACK_MESSAGE.format(name=user_name, user_id=user.id, option=option),
                 parse_mode="markdown",
             )
             await self.client.forward_messages(
@@ -161,38 +300,55 @@ class FeedbackBot:
             event.chat_id,
         ))
 
-    def start(self) -> None:
-        start_time.set_to_current_time()
+    async def _run(self) -> None:
         channel_ids = list(self.channel_dict.keys())
         self.client.add_event_handler(
-            self.handle_new_message,
-            events.NewMessage(chats=channel_ids, forwards=False)
-        )
-        self.client.add_event_handler(
-            self.handle_forwarded_message,
-            events.NewMessage(chats=channel_ids, forwards=True)
+            self.handle_message,
+            events.NewMessage(chats=channel_ids)
         )
         self.client.add_event_handler(
             self.handle_callback_button,
-            events.CallbackQuery(pattern="^option:")
+            events.CallbackQuery()
         )
-        loop = asyncio.get_event_loop()
-        self.schedule_task = loop.create_task(self.schedule_store.run())
-        start_http_server(self.prom_port)
+        # Serve metrics from the bot's own event loop, rather than a separate thread
+        self.metrics_server = await start_http_server(port=self.prom_port)
+        self.schedule_task = asyncio.create_task(self.schedule_store.run())
         logger.info("Handlers registered, running")
-        self.client.run_until_disconnected()
-        logger.info("Shutting down")
-        self.schedule_store.stop()
-        logger.info("Shutdown complete")
+        await self.client.run_until_disconnected()
+
+    def start(self) -> None:
+        start_time.set_to_current_time()
+        loop = self.client.loop
+        run_task = loop.create_task(self._run())
+        try:
+            loop.run_until_complete(run_task)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            logger.info("Shutting down")
+            # Let cancelled tasks finish unwinding, so the schedule store gets back any posts it was sending
+            for task in [run_task, self.schedule_task]:
+                if task is not None and not task.done():
+                    task.cancel()
+                    loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+            if self.metrics_server is not None:
+                loop.run_until_complete(self.metrics_server.close())
+            self.client.disconnect()
+            self.schedule_store.stop()
+            logger.info("Shutdown complete")
 
     @classmethod
     def from_config(cls, config: Dict) -> 'FeedbackBot':
+        # Check the whole config before connecting, so that all problems are reported at once
+        problems = _validate_config(config)
+        if problems:
+            raise ConfigError(problems)
+        channels = [Channel.from_json(c) for c in config["channels"]]
         client = TelegramClient(
             "feedback_bot",
             config["api_id"],
             config["api_hash"]
         )
         client.start(bot_token=config["bot_token"])
-        channels = [Channel.from_json(c) for c in config["channels"]]
         prom_port = config.get("prom_port", 7066)
         return cls(client, channels, prom_port)
@@ -1,12 +1,17 @@
 import asyncio
-import json
+import heapq
+import itertools
 import logging
+import os
+import threading
+import time
 from abc import ABC, abstractmethod
 import datetime
+from typing import Optional, ClassVar
 
+import orjson
 from prometheus_client import Gauge
 from telethon import TelegramClient
-import dateutil.parser
 
 logger = logging.getLogger(__name__)
 
@@ -20,8 +25,25 @@ latest_check_time = Gauge(
     "Unix timestamp of the last time the schedule store checked for scheduled messages",
 )
 
+FEEDBACK_MESSAGE = "User [{name}](tg://user?id={user_id}) has sent feedback: {option}"
+
+
+def _parse_time(time_str: str) -> datetime.datetime:
+    # fromisoformat() only accepts a trailing Z from python 3.11
+    if time_str.endswith("Z"):
+        time_str = time_str[:-1] + "+00:00"
+    return datetime.datetime.fromisoformat(time_str)
+
 
 class ScheduledPost(ABC):
+    __slots__ = ("feedback_group_id", "schedule_time")
+    TYPE: ClassVar[str]
+    _REGISTRY: ClassVar[dict[str, type["ScheduledPost"]]] = {}
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        ScheduledPost._REGISTRY[cls.TYPE] = cls
+
     def __init__(self, feedback_group_id: int, schedule_time: datetime.datetime) -> None:
         self.feedback_group_id = feedback_group_id
         self.schedule_time: datetime.datetime = schedule_time
@@ -32,9 +54,11 @@ class ScheduledPost(ABC):
 
     @classmethod
     def from_json(cls, data: dict) -> "ScheduledPost":
-        if "fwd_msg_id" in data:
-            return ScheduledForward.from_json(data)
-        return ScheduledMessage.from_json(data)
+        post_type = data.get("type")
+        if post_type is None:
+            # Posts saved before the type was stored
+            post_type = ScheduledForward.TYPE if "fwd_msg_id" in data else ScheduledMessage.TYPE
+        return ScheduledPost._REGISTRY[post_type].from_json(data)
 
     @abstractmethod
     async def send_message(self, client: TelegramClient) -> None:
@@ -42,6 +66,8 @@ class ScheduledPost(ABC):
 
 
 class ScheduledMessage(ScheduledPost):
+    __slots__ = ("username", "user_id", "option")
+    TYPE = "message"
 
     def __init__(
             self,
@@ -58,6 +84,7 @@ class ScheduledMessage(ScheduledPost):
 
     def to_json(self) -> dict:
         return {
+            "type": self.TYPE,
             "feedback_group_id": self.feedback_group_id,
             "schedule_time": self.schedule_time.isoformat(),
             "username": self.username,
@@ -69,7 +96,7 @@ class ScheduledMessage(ScheduledPost):
     def from_json(cls, data: dict) -> "ScheduledMessage":
         return cls(
             data["feedback_group_id"],
-            dateutil.parser.parse(data["schedule_time"]),
+            _parse_time(data["schedule_time"]),
             data["username"],
             data["user_id"],
             data["option"],
@@ -78,12 +105,14 @@ class ScheduledMessage(ScheduledPost):
     async def send_message(self, client: TelegramClient) -> None:
         await client.send_message(
             self.feedback_group_id,
-            f"User [{self.username}](tg://user?id={self.user_id}) has sent feedback: {self.option}",
+            FEEDBACK_MESSAGE.format(name=self.username, user_id=self.user_id, option=self.option),
             parse_mode="markdown",
         )
 
 
 class ScheduledForward(ScheduledPost):
+    __slots__ = ("fwd_msg_id", "fwd_chat_id")
+    TYPE = "forward"
 
     def __init__(
             self,
@@ -98,6 +127,7 @@ class ScheduledForward(ScheduledPost):
 
     def to_json(self) -> dict:
         return {
+            "type": self.TYPE,
             "feedback_group_id": self.feedback_group_id,
             "schedule_time": self.schedule_time.isoformat(),
             "fwd_msg_id": self.fwd_msg_id,
@@ -108,7 +138,7 @@ class ScheduledForward(ScheduledPost):
     def from_json(cls, data: dict) -> "ScheduledForward":
         return cls(
             data["feedback_group_id"],
-            dateutil.parser.parse(data["schedule_time"]),
+            _parse_time(data["schedule_time"]),
             data["fwd_msg_id"],
             data["fwd_chat_id"],
         )
@@ -122,43 +152,137 @@ class ScheduledForward(ScheduledPost):
 class ScheduleStore:
     FILENAME = "schedule_store.json"
     WAIT_BEFORE_CHECK_SECONDS = 60 * 5
+    MIN_WAIT_SECONDS = 1.0
+    SAVE_DELAY_SECONDS = 1.0
+    MAX_CONCURRENT_SENDS = 5
 
     def __init__(self, scheduled_posts: list[ScheduledPost], client: TelegramClient) -> None:
-        self.scheduled_posts: list[ScheduledPost] = scheduled_posts
+        # Min-heap of (schedule unix timestamp, insertion counter, post), the counter breaks ties between posts
+        self._counter = itertools.count()
+        self.scheduled_posts: list[tuple[float, int, ScheduledPost]] = [
+            self._heap_entry(post) for post in scheduled_posts
+        ]
+        heapq.heapify(self.scheduled_posts)
         self.client = client
         self.running = False
+        self._dirty = False
+        self._flush_task: Optional[asyncio.Task] = None
+        # Writes can come from a flush thread and from stop(), so they are serialised, and stale snapshots skipped
+        self._write_lock = threading.Lock()
+        self._snapshot_counter = itertools.count()
+        self._written_snapshot = -1
+        self._wake = asyncio.Event()
         schedule_store_size.set_function(lambda: len(self.scheduled_posts))
 
     @classmethod
     def load_from_json(cls, client: TelegramClient) -> "ScheduleStore":
         try:
-            with open(cls.FILENAME, "r") as f:
-                raw_data = json.load(f)
+            with open(cls.FILENAME, "rb") as f:
+                raw_data = orjson.loads(f.read())
         except FileNotFoundError:
             return cls([], client)
         scheduled_posts = [ScheduledPost.from_json(data) for data in raw_data["scheduled_posts"]]
         return cls(scheduled_posts, client)
 
-    def save_to_json(self) -> None:
-        raw_data = {
-            "scheduled_posts": [post.to_json() for post in self.scheduled_posts]
+    def _raw_data(self) -> tuple[int, dict]:
+        return next(self._snapshot_counter), {
+            "scheduled_posts": [post.to_json() for _, _, post in self.scheduled_posts]
         }
-        with open(self.FILENAME, "w") as f:
-            json.dump(raw_data, f, indent=2)
+
+    def _write_json(self, snapshot: int, raw_data: dict) -> None:
+        with self._write_lock:
+            if snapshot < self._written_snapshot:
+                return
+            # Write to a temporary file and swap it in, so a crash mid-write can't corrupt the store
+            tmp_filename = self.FILENAME + ".tmp"
+            with open(tmp_filename, "wb") as f:
+                f.write(orjson.dumps(raw_data))
+            os.replace(tmp_filename, self.FILENAME)
+            self._written_snapshot = snapshot
+
+    def save_to_json(self) -> None:
+        self._dirty = False
+        self._write_json(*self._raw_data())
+
+    async def flush(self) -> None:
+        if not self._dirty:
+            return
+        self._dirty = False
+        # Serialise on the event loop, so the posts can't change underneath us, then write in a thread
+        await asyncio.to_thread(self._write_json, *self._raw_data())
+
+    async def _flush_later(self) -> None:
+        try:
+            await asyncio.sleep(self.SAVE_DELAY_SECONDS)
+            await self.flush()
+        except asyncio.CancelledError:
+            self._dirty = True
+            self._flush_task = None
+            raise
+        except Exception as e:
+            self._dirty = True
+            logger.warning("Failed to save schedule store", exc_info=e)
+        self._flush_task = None
+        # Save anything which changed while this flush was writing, or retry a failed save
+        if self._dirty:
+            self._mark_dirty()
+
+    def _mark_dirty(self) -> None:
+        self._dirty = True
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    def _heap_entry(self, post: ScheduledPost) -> tuple[float, int, ScheduledPost]:
+        # Compare posts by float timestamp, which is much cheaper than comparing timezone aware datetimes
+        return post.schedule_time.timestamp(), next(self._counter), post
 
     def schedule(self, post: ScheduledPost) -> None:
-        self.scheduled_posts.append(post)
-        self.save_to_json()
+        heapq.heappush(self.scheduled_posts, self._heap_entry(post))
+        self._mark_dirty()
+        # Wake the watcher if this post is due before whatever it was waiting for
+        if self.scheduled_posts[0][2] is post:
+            self._wake.set()
 
     async def send_all(self) -> None:
         logger.info("Checking for new scheduled posts to send")
         latest_check_time.set_to_current_time()
-        now = datetime.datetime.now(datetime.timezone.utc)
-        for post in self.scheduled_posts[:]:
-            if post.schedule_time < now:
-                await post.send_message(self.client)
-                self.scheduled_posts.remove(post)
-                self.save_to_json()
+        now = time.time()
+        # Posts for each feedback group are sent in order, so that feedback messages stay next to their forwards
+        due: dict[int, list[tuple[float, int, ScheduledPost]]] = {}
+        while self.scheduled_posts and self.scheduled_posts[0][0] < now:
+            entry = heapq.heappop(self.scheduled_posts)
+            due.setdefault(entry[2].feedback_group_id, []).append(entry)
+        if not due:
+            return
+        semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_SENDS)
+        try:
+            await asyncio.gather(*(self._send_group(entries, semaphore) for entries in due.values()))
+        except asyncio.CancelledError:
+            # Shutting down, so leave saving to stop() rather than queueing a flush
+            self._dirty = True
+            raise
+        self._mark_dirty()
+
+    async def _send_group(
+            self,
+            entries: list[tuple[float, int, ScheduledPost]],
+            semaphore: asyncio.Semaphore,
+    ) -> None:
+        sent = 0
+        retry_time: Optional[float] = None
+        try:
+            async with semaphore:
+                for entry in entries:
+                    await entry[2].send_message(self.client)
+                    sent += 1
+        except Exception as e:
+            logger.warning("Failed to send scheduled post", exc_info=e)
+            # Back off before retrying this group, without holding up posts for other groups
+            retry_time = time.time() + self.WAIT_BEFORE_CHECK_SECONDS
+        finally:
+            # Put back any posts which weren't sent, including if cancelled, to retry them in order later
+            for schedule_ts, counter, post in entries[sent:]:
+                heapq.heappush(self.scheduled_posts, (retry_time or schedule_ts, counter, post))
 
     async def run(self) -> None:
         self.running = True
@@ -168,8 +292,27 @@ class ScheduleStore:
                 await self.send_all()
             except Exception as e:
                 logger.warning("Failed to send all scheduled posts", exc_info=e)
-            await asyncio.sleep(self.WAIT_BEFORE_CHECK_SECONDS)
+            await self._wait_for_next_check()
         logger.info("Schedule store shutting down")
 
+    def _next_check_delay(self) -> float:
+        if not self.scheduled_posts:
+            return self.WAIT_BEFORE_CHECK_SECONDS
+        delay = self.scheduled_posts[0][0] - time.time()
+        return min(max(self.MIN_WAIT_SECONDS, delay), self.WAIT_BEFORE_CHECK_SECONDS)
+
+    async def _wait_for_next_check(self) -> None:
+        self._wake.clear()
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout=self._next_check_delay())
+        except asyncio.TimeoutError:
+            pass
+
     def stop(self) -> None:
         self.running = False
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+            self._dirty = True
+        if self._dirty:
+            self.save_to_json()
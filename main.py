@@ -2,10 +2,11 @@
 
 # Press Shift+F10 to execute it or replace it with your code.
 # Press Double Shift to search everywhere for classes, files, tool windows, actions, and settings.
-import json
 import logging
 import sys
 
+import orjson
+
 from feedback_bot.feedback_bot import FeedbackBot
 
 
@@ -20,7 +21,7 @@ def setup_logging() -> None:
 
 if __name__ == '__main__':
     setup_logging()
-    with open("config.json", "r") as f:
-        config = json.load(f)
+    with open("config.json", "rb") as f:
+        config = orjson.loads(f.read())
     bot = FeedbackBot.from_config(config)
     bot.start()